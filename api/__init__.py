@@ -1,3 +1,7 @@
+# load .env before any api module is imported, several of them read the environment at import time
+from dotenv import load_dotenv
+load_dotenv()
+
 from api.create_app import create_app
 
 
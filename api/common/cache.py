@@ -1,16 +1,39 @@
+import fnmatch
 import inspect
 import logging
 import msgpack
 import os
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
 
 import redis
+from flask import g, has_request_context
+
+
+def create_redis_pool():
+    redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    return redis.BlockingConnectionPool.from_url(
+        redis_url,
+        max_connections=int(os.getenv("REDIS_POOL", "64")),
+        timeout=5,
+        socket_keepalive=True,
+        health_check_interval=30,
+        retry_on_timeout=True
+    )
+
+
+POOL = create_redis_pool()
+
+
+def get_pool():
+    return POOL
 
 
 def create_redis_client():
     try:
-        redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
-        client = redis.Redis.from_url(redis_url)
+        client = redis.Redis(connection_pool=POOL)
         client.ping()
         logging.info("Redis available.")
         return client
@@ -22,7 +45,131 @@ def create_redis_client():
 REDIS = create_redis_client()
 
 
+LUA_DELETE_MANY = """
+local deleted = 0
+if #KEYS > 0 then
+    deleted = redis.call("UNLINK", unpack(KEYS))
+end
+for _, pattern in ipairs(ARGV) do
+    local cursor = "0"
+    repeat
+        local result = redis.call("SCAN", cursor, "MATCH", pattern, "COUNT", 1000)
+        cursor = result[1]
+        local keys = result[2]
+        for i = 1, #keys, 500 do
+            deleted = deleted + redis.call("UNLINK", unpack(keys, i, math.min(i + 499, #keys)))
+        end
+    until cursor == "0"
+end
+return deleted
+"""
+
+LUA_ADD_TO_HSET = """
+local max_length = tonumber(ARGV[3])
+if redis.call("LLEN", KEYS[2]) >= max_length then
+    local oldest_id = redis.call("RPOP", KEYS[2])
+    if oldest_id then
+        redis.call("HDEL", KEYS[1], oldest_id)
+    end
+end
+redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+redis.call("LPUSH", KEYS[2], ARGV[1])
+redis.call("LTRIM", KEYS[2], 0, max_length - 1)
+return 1
+"""
+
+LUA_ADD_TO_SET = """
+local added = redis.call("SADD", KEYS[1], ARGV[1])
+if ARGV[2] ~= "" and redis.call("TTL", KEYS[1]) < 0 then
+    redis.call("EXPIRE", KEYS[1], ARGV[2])
+end
+return added
+"""
+
+LUA_INCR_WITH_TTL = """
+local value = redis.call("INCRBY", KEYS[1], ARGV[1])
+if redis.call("TTL", KEYS[1]) < 0 then
+    redis.call("EXPIRE", KEYS[1], ARGV[2])
+end
+return value
+"""
+
+LUA_TOKEN_BUCKET = """
+local capacity = tonumber(ARGV[1])
+local refill_rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(bucket[1]) or capacity
+local last = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - last) * refill_rate)
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "ts", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / refill_rate) + 1)
+return allowed
+"""
+
+
+def load_script(script):
+    try:
+        if REDIS is None:
+            return None
+        return REDIS.script_load(script)
+    except Exception:
+        return None
+
+
 class RedisCache:
+    DELETE_MANY_SHA = load_script(LUA_DELETE_MANY)
+    ADD_TO_HSET_SHA = load_script(LUA_ADD_TO_HSET)
+    ADD_TO_SET_SHA = load_script(LUA_ADD_TO_SET)
+    INCR_WITH_TTL_SHA = load_script(LUA_INCR_WITH_TTL)
+    TOKEN_BUCKET_SHA = load_script(LUA_TOKEN_BUCKET)
+
+    @staticmethod
+    def encode_msgpack(value):
+        return b"m" + msgpack.packb(value, use_bin_type=True)
+
+    # one-byte type tag + payload, anything not listed here is msgpack-encoded; ints (and bools) stay untagged
+    # so INCR/INCRBY/DECRBY keep working on them, they never start with a tag byte
+    ENCODERS = {
+        bool: lambda value: str(int(value)).encode(),
+        int: lambda value: str(value).encode(),
+        float: lambda value: b"f" + repr(value).encode(),
+        str: lambda value: b"s" + value.encode("utf-8"),
+    }
+    DECODERS = {
+        b"f": float,
+        b"s": lambda payload: payload.decode("utf-8"),
+        b"m": lambda payload: msgpack.unpackb(payload, raw=False, strict_map_key=False),
+    }
+
+    @staticmethod
+    def _eval_script(script, sha, numkeys, *args):
+        if sha is not None:
+            try:
+                return REDIS.evalsha(sha, numkeys, *args)
+            except redis.exceptions.NoScriptError:
+                pass
+        return REDIS.eval(script, numkeys, *args)
+
+    @staticmethod
+    def _decode(value):
+        if value is None:
+            return None
+
+        # values are prefixed with a one-byte type tag, see RedisCache.ENCODERS
+        if decoder := RedisCache.DECODERS.get(value[:1]):
+            return decoder(value[1:])
+
+        # untagged values are ints, either set() directly or written by INCR/INCRBY/DECRBY
+        return int(value)
+
     @staticmethod
     def get(key, new_expiry=None):
         try:
@@ -30,35 +177,36 @@ class RedisCache:
                 return None
             if new_expiry is not None:
                 REDIS.expire(key, new_expiry)
-            value = REDIS.get(key)
-            if value is None:
-                return None
+            return RedisCache._decode(REDIS.get(key))
+        except Exception:
+            return None
 
-            for data_type in (int, float):
-                try:
-                    return data_type(value)
-                except ValueError:
-                    continue
+    @staticmethod
+    def get_many(keys: list) -> list:
+        """Fetch several keys in a single MGET round-trip, None for misses and undecodable values."""
+        try:
+            if REDIS is None or not keys:
+                return [None] * len(keys)
+            values = REDIS.mget(keys)
+        except Exception:
+            return [None] * len(keys)
 
+        decoded = []
+        for value in values:
             try:
-                return value.decode('utf-8')
-            except (ValueError, AttributeError):
-                return msgpack.unpackb(value, raw=False, strict_map_key=False)
-        except Exception:
-            return None
+                decoded.append(RedisCache._decode(value))
+            except Exception:
+                decoded.append(None)
+        return decoded
 
     @staticmethod
     def set(key, value, ex: int | None = None):
         try:
             if REDIS is None:
                 return False
-            if isinstance(value, bool):
-                REDIS.set(key, int(value), ex=ex)
-            elif isinstance(value, (str, int, float)):
-                REDIS.set(key, value, ex=ex)
-            else:
-                packed_value = msgpack.packb(value, use_bin_type=True)
-                REDIS.set(key, packed_value, ex=ex)
+            encoder = RedisCache.ENCODERS.get(type(value), RedisCache.encode_msgpack)
+            packed_value = encoder(value)
+            REDIS.set(key, packed_value, ex=ex)
             return True
         except Exception:
             return False
@@ -77,11 +225,11 @@ class RedisCache:
         try:
             if REDIS is None:
                 return False
-            pipeline = REDIS.pipeline()
-            pipeline.sadd(key, value)
-            if ex is not None:  # Fixed: was checking if ex is None
-                pipeline.expire(key, ex)
-            pipeline.execute()
+            # the TTL is only set when the set has none yet, instead of being renewed on every add
+            RedisCache._eval_script(
+                LUA_ADD_TO_SET, RedisCache.ADD_TO_SET_SHA, 1,
+                key, value, "" if ex is None else ex
+            )
             return True
         except Exception:
             return False
@@ -106,6 +254,7 @@ class RedisCache:
 
     @staticmethod
     def get_set(key):
+        """Deprecated: loads the whole set with SMEMBERS, prefer iter_set."""
         try:
             if REDIS is None:
                 return set()
@@ -113,6 +262,15 @@ class RedisCache:
         except Exception:
             return set()
 
+    @staticmethod
+    def iter_set(key, count: int = 500):
+        try:
+            if REDIS is None:
+                return iter([])
+            return REDIS.sscan_iter(key, count=count)
+        except Exception:
+            return iter([])
+
     @staticmethod
     def incr(key):
         try:
@@ -140,6 +298,33 @@ class RedisCache:
         except Exception:
             return None
 
+    @staticmethod
+    def incr_with_ttl(key, amount: int, ex: int):
+        try:
+            if REDIS is None:
+                return None
+            # the TTL is set atomically with the first increment and never renewed
+            return RedisCache._eval_script(LUA_INCR_WITH_TTL, RedisCache.INCR_WITH_TTL_SHA, 1, key, amount, ex)
+        except Exception:
+            return None
+
+    @staticmethod
+    def take_token(key, capacity: int, refill_rate: float, cost: int = 1):
+        """Take cost tokens from the bucket at key, refilled at refill_rate per second up to capacity.
+
+        Returns True if the tokens were taken, False if the bucket is empty, and None if Redis is unavailable.
+        """
+        try:
+            if REDIS is None:
+                return None
+            # refill and take happen atomically on the Redis server, in a single round-trip
+            return bool(RedisCache._eval_script(
+                LUA_TOKEN_BUCKET, RedisCache.TOKEN_BUCKET_SHA, 1,
+                key, capacity, refill_rate, cost
+            ))
+        except Exception:
+            return None
+
     @staticmethod
     def expire(key, ex):
         try:
@@ -172,36 +357,22 @@ class RedisCache:
 
     @staticmethod
     def delete_fuzzy(substring, starts_with: bool = False, ends_with: bool = False):
-        try:
-            if REDIS is None:
-                return False
-            cursor = '0'
-            pipeline = REDIS.pipeline()
-            while cursor != 0:
-                cursor, keys = REDIS.scan(
-                    cursor=cursor,
-                    match=f"{'' if starts_with else '*'}{substring}{'' if ends_with else '*'}",
-                    count=1000
-                )
-                if keys:
-                    pipeline.delete(*keys)
-            pipeline.execute()
-            return True
-        except Exception:
-            return False
+        pattern = f"{'' if starts_with else '*'}{substring}{'' if ends_with else '*'}"
+        return RedisCache.delete_pattern(pattern)
 
     @staticmethod
     def delete_pattern(pattern):
+        return RedisCache.delete_many(patterns=[pattern])
+
+    @staticmethod
+    def delete_many(keys=(), patterns=()):
+        """Unlink exact keys and all keys matching the patterns in a single script call."""
         try:
             if REDIS is None:
                 return False
-            cursor = '0'
-            pipeline = REDIS.pipeline()
-            while cursor != 0:
-                cursor, keys = REDIS.scan(cursor=cursor, match=pattern, count=1000)
-                if keys:
-                    pipeline.delete(*keys)
-            pipeline.execute()
+            if not keys and not patterns:
+                return True
+            RedisCache._eval_script(LUA_DELETE_MANY, RedisCache.DELETE_MANY_SHA, len(keys), *keys, *patterns)
             return True
         except Exception:
             return False
@@ -211,54 +382,164 @@ class RedisCache:
         try:
             if REDIS is None:
                 return False
-            pipeline = REDIS.pipeline()
-            pipeline.hset(hset_key, key, value)
-            pipeline.lpush(f"{hset_key}_order", key)
-            pipeline.ltrim(f"{hset_key}_order", 0, max_length - 1)
-
-            # Check if we need to remove old entries
-            if REDIS.llen(f"{hset_key}_order") >= max_length:
-                oldest_id = REDIS.rpop(f"{hset_key}_order")
-                if oldest_id:
-                    pipeline.hdel(hset_key, oldest_id)
-
-            pipeline.execute()
+            # pre-encoded bytes are stored as-is, anything else is msgpack-encoded (never str()-coerced)
+            if not isinstance(value, (bytes, bytearray, memoryview)):
+                value = msgpack.packb(value, use_bin_type=True)
+            RedisCache._eval_script(
+                LUA_ADD_TO_HSET, RedisCache.ADD_TO_HSET_SHA, 2,
+                hset_key, f"{hset_key}_order", key, value, max_length
+            )
             return True
         except Exception:
             return False
 
-def redis_cache(key_pattern, ex=300):
-    """Decorator for caching function results in Redis."""
+class LocalCache:
+    """In-process LRU with per-key TTL, checked before Redis by redis_cache.
+
+    Cached objects are shared between callers and must not be mutated.
+    """
+
+    MAX_ENTRIES = 10000
+
+    _store: OrderedDict = OrderedDict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get(key):
+        with LocalCache._lock:
+            item = LocalCache._store.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del LocalCache._store[key]
+                return None
+            LocalCache._store.move_to_end(key)
+            return value
+
+    @staticmethod
+    def set(key, value, ex):
+        with LocalCache._lock:
+            LocalCache._store[key] = (time.monotonic() + ex, value)
+            LocalCache._store.move_to_end(key)
+            while len(LocalCache._store) > LocalCache.MAX_ENTRIES:
+                LocalCache._store.popitem(last=False)
+
+    @staticmethod
+    def delete(key):
+        with LocalCache._lock:
+            LocalCache._store.pop(key, None)
+
+    @staticmethod
+    def delete_pattern(pattern):
+        with LocalCache._lock:
+            for key in [key for key in LocalCache._store if fnmatch.fnmatchcase(key, pattern)]:
+                del LocalCache._store[key]
+
+
+def _argument_binder(func):
+    """Resolve call arguments to a name -> value dict, excluding self/cls, without Signature.bind per call."""
+    parameters = list(inspect.signature(func).parameters.values())
+    skip = 1 if parameters and parameters[0].name in ["self", "cls"] else 0
+    parameters = parameters[skip:]
+    names = [parameter.name for parameter in parameters]
+    defaults = {
+        parameter.name: parameter.default
+        for parameter in parameters
+        if parameter.default is not inspect.Parameter.empty
+    }
+
+    def bind(args, kwargs):
+        all_args = dict(defaults)
+        all_args.update(zip(names, args[skip:]))
+        all_args.update(kwargs)
+        return all_args
+
+    return bind
+
+
+def redis_cache(key_pattern, ex=300, l1_ex=5):
+    """Decorator for caching function results in Redis, fronted by LocalCache for l1_ex seconds (0 disables)."""
 
     def decorator(func):
+        bind = _argument_binder(func)
+
         @wraps(func)
         def wrapper(*args, **kwargs):
-            sig = inspect.signature(func)
-            bound_args = sig.bind(*args, **kwargs)
-            bound_args.apply_defaults()
-
-            all_args = bound_args.arguments
-
-            if args and list(all_args.keys())[0] in ['self', 'cls']:
-                all_args = dict(all_args)
-                first_key = list(all_args.keys())[0]
-                del all_args[first_key]
+            all_args = bind(args, kwargs)
 
             try:
                 redis_key = key_pattern.format(**all_args)
             except KeyError as e:
                 raise ValueError(f"Key pattern references argument '{e}' not present in function call")
 
-            # Check if data is in Redis cache
+            # Check if data is in local or Redis cache
+            if l1_ex and (cached_data := LocalCache.get(redis_key)):
+                return cached_data
             if cached_data := RedisCache.get(redis_key):
+                if l1_ex:
+                    LocalCache.set(redis_key, cached_data, l1_ex)
                 return cached_data
 
             result = func(*args, **kwargs)
 
             RedisCache.set(redis_key, result, ex=ex if result else 30)
+            if l1_ex and result:
+                LocalCache.set(redis_key, result, l1_ex)
 
             return result
 
+        def cache_key(*args, **kwargs):
+            return key_pattern.format(**bind(args, kwargs))
+
+        wrapper.cache_key = cache_key
+        wrapper.l1_ex = l1_ex
+        return wrapper
+
+    return decorator
+
+
+def redis_cache_prefetch(*cached_calls):
+    """Warm LocalCache for several redis_cache calls with a single MGET.
+
+    Each call is a (cached_func, kwargs) pair; the wrapped functions then hit LocalCache instead of Redis.
+    """
+    pending = {}
+    for cached_func, kwargs in cached_calls:
+        if not cached_func.l1_ex:
+            continue
+        key = cached_func.cache_key(**kwargs)
+        if LocalCache.get(key) is None:
+            pending[key] = cached_func.l1_ex
+    if not pending:
+        return
+
+    for (key, l1_ex), value in zip(pending.items(), RedisCache.get_many(list(pending))):
+        if value:
+            LocalCache.set(key, value, l1_ex)
+
+
+def request_cache(key_pattern):
+    """Decorator memoizing results on flask.g for the rest of the current request.
+
+    Stacked on top of redis_cache, repeated calls within one request skip the cache lookups entirely.
+    Outside a request context the function is simply called.
+    """
+
+    def decorator(func):
+        bind = _argument_binder(func)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not has_request_context():
+                return func(*args, **kwargs)
+
+            key = key_pattern.format(**bind(args, kwargs))
+            results = g.setdefault("request_cache", {})
+            if key not in results:
+                results[key] = func(*args, **kwargs)
+            return results[key]
+
         return wrapper
 
     return decorator
@@ -270,35 +551,33 @@ def redis_cache_bust(key_patterns: list | str):
     if isinstance(key_patterns, str):
         key_patterns = [key_patterns]
 
+    # Split wildcard patterns once: (pattern, prefix, suffix), with prefix None for exact keys
+    split_patterns = []
+    for key_pattern in key_patterns:
+        if '*' in key_pattern:
+            pattern_prefix, pattern_suffix = key_pattern.split('*', 1)  # Split on first '*'
+            split_patterns.append((key_pattern, pattern_prefix, pattern_suffix))
+        else:
+            split_patterns.append((key_pattern, None, None))
+
     def decorator(func):
+        bind = _argument_binder(func)
+
         @wraps(func)
         def wrapper(*args, **kwargs):
             # First call the original function
             result = func(*args, **kwargs)
 
-            # Get the argument names from the function
-            sig = inspect.signature(func)
-            bound_args = sig.bind(*args, **kwargs)
-            bound_args.apply_defaults()
+            # Create a dictionary with all arguments (positional and keyword), without 'self' or 'cls'
+            all_args = bind(args, kwargs)
 
-            # Create a dictionary with all arguments (positional and keyword)
-            all_args = bound_args.arguments
-
-            # If it's a method, remove 'self' or 'cls' from arguments
-            if args and list(all_args.keys())[0] in ['self', 'cls']:
-                all_args = dict(all_args)
-                first_key = list(all_args.keys())[0]
-                del all_args[first_key]
+            exact_keys = []
+            wildcard_patterns = []
 
             # Process each key pattern
-            for key_pattern in key_patterns:
+            for key_pattern, pattern_prefix, pattern_suffix in split_patterns:
                 # Check if we need to do wildcard deletion
-                if '*' in key_pattern:
-                    # Handle wildcard in the pattern
-                    parts = key_pattern.split('*', 1)  # Split on first '*'
-                    pattern_prefix = parts[0]
-                    pattern_suffix = parts[1] if len(parts) > 1 else ""
-
+                if pattern_prefix is not None:
                     # Format the parts with available arguments if needed
                     try:
                         formatted_prefix = pattern_prefix.format(**all_args)
@@ -312,7 +591,8 @@ def redis_cache_bust(key_patterns: list | str):
 
                     # Construct the final pattern: formatted_prefix + * + formatted_suffix
                     final_pattern = f"{formatted_prefix}*{formatted_suffix}"
-                    RedisCache.delete_pattern(final_pattern)
+                    wildcard_patterns.append(final_pattern)
+                    LocalCache.delete_pattern(final_pattern)
                 else:
                     # Format the Redis key using the provided pattern and arguments
                     try:
@@ -321,7 +601,11 @@ def redis_cache_bust(key_patterns: list | str):
                         raise ValueError(f"Key pattern references argument '{e}' not present in function call")
 
                     # Delete the specific key
-                    RedisCache.delete(redis_key)
+                    exact_keys.append(redis_key)
+                    LocalCache.delete(redis_key)
+
+            # Delete all keys and patterns in one round trip
+            RedisCache.delete_many(exact_keys, wildcard_patterns)
 
             return result
 
@@ -0,0 +1,11 @@
+from datetime import date
+
+
+def parse_ymd(text: str) -> date:
+    """Parse a canonical 'YYYY-MM-DD' string without strptime's format parsing."""
+    return date(int(text[:4]), int(text[5:7]), int(text[8:10]))
+
+
+def format_ymd(value: date) -> str:
+    """Format a date as 'YYYY-MM-DD' without strftime."""
+    return f"{value.year:04d}-{value.month:02d}-{value.day:02d}"
@@ -1,26 +1,80 @@
+import ipaddress
 import os
+from functools import lru_cache, wraps
 
-import redis
 from flask import request
 from flask_limiter import Limiter
 
+from api.common.cache import REDIS, RedisCache
+from api.common.response import TommyErrors
 
-def create_redis_for_limiter():
+
+# comma-separated CIDRs of trusted internal callers, e.g. "10.0.0.0/8,172.16.0.0/12", exempt from rate limits
+INTERNAL_NETWORKS = tuple(
+    ipaddress.ip_network(cidr.strip(), strict=False)
+    for cidr in os.getenv("LIMITER_INTERNAL_CIDRS", "").split(",")
+    if cidr.strip()
+)
+
+
+def get_client_key():
+    return request.remote_addr
+
+
+@lru_cache(maxsize=4096)
+def is_internal_address(address: str | None) -> bool:
+    if not INTERNAL_NETWORKS or not address:
+        return False
     try:
-        redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
-        client = redis.Redis.from_url(redis_url)
-        client.ping()
-        return client
-    except Exception:
-        return None
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in INTERNAL_NETWORKS)
+
+
+def is_internal_request() -> bool:
+    return is_internal_address(request.remote_addr)
 
 
 LIMITER = Limiter(
-    key_func=lambda: request.remote_addr,
-    storage_uri=os.getenv("REDIS_URL", "redis://localhost:6379/0") if create_redis_for_limiter() else "memory://",
-    storage_options={"socket_connect_timeout": 30},
+    key_func=get_client_key,
+    storage_uri=os.getenv("REDIS_URL", "redis://localhost:6379/0") if REDIS is not None else "memory://",
+    storage_options={"connection_pool": REDIS.connection_pool, "socket_connect_timeout": 30} if REDIS is not None else {},
     strategy="fixed-window",
     default_limits=["30 per minute"],
+    default_limits_exempt_when=is_internal_request,
     swallow_errors=True
 )
 
+
+def token_bucket_limit(capacity: int, per_seconds: int, key_func=get_client_key, scope: str | None = None):
+    """Decorator rate limiting with a Redis token bucket: bursts of up to capacity, refilled at capacity per_seconds.
+
+    Unlike a fixed window there is no burst at window boundaries. Requests are let through when Redis errors,
+    like the LIMITER with swallow_errors, and internal requests are never limited. Without Redis the decorator
+    is a no-op, so resources using it should be exempted with token_bucket_exempt rather than LIMITER.exempt.
+    """
+    refill_rate = capacity / per_seconds
+
+    def decorator(func):
+        if REDIS is None:
+            return func
+
+        key_prefix = f"limiter:bucket:{scope or func.__qualname__}"
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if is_internal_request():
+                return func(*args, **kwargs)
+            if RedisCache.take_token(f"{key_prefix}:{key_func()}", capacity, refill_rate) is False:
+                return TommyErrors.too_many_requests_error(message="Rate limit exceeded. Please try again later.")
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def token_bucket_exempt(obj):
+    """Exempt obj from the LIMITER's default limits, but only when the token bucket is active (Redis available)."""
+    return LIMITER.exempt(obj) if REDIS is not None else obj
@@ -1,11 +1,21 @@
-import json
 from datetime import date
+from functools import lru_cache
 from typing import Dict, Optional
 
 from openai import OpenAI
 from pydantic import BaseModel, Field
 
 
+OPENAI_CLIENT = None
+
+
+def get_client() -> OpenAI:
+    """Lazily create the process-wide OpenAI client, after .env has been loaded."""
+    global OPENAI_CLIENT
+    if OPENAI_CLIENT is None:
+        OPENAI_CLIENT = OpenAI()
+    return OPENAI_CLIENT
+
 
 class DateRange(BaseModel):
     start: date = Field(description="Start date in YYYY-MM-DD")
@@ -48,12 +58,16 @@ class ParserAI:
         Besides "dates" (today (minimum) is '{current_date}'), the following filters are available:
     """
 
+    @staticmethod
+    @lru_cache(maxsize=128)
+    def _build_system_prompt(current_date: str, filters: str) -> str:
+        return ParserAI.SYSTEM_PROMPT.format(current_date=current_date) + filters
+
     def _get_system_prompt(self, filters: str):
-        current_date = date.today()
-        return self.SYSTEM_PROMPT.format(current_date=current_date.isoformat()) + filters
+        return self._build_system_prompt(date.today().isoformat(), filters)
 
     def parse(self, user_query: str, filters: str, catalog_id: str) -> dict:
-        client = OpenAI()
+        client = get_client()
         system_prompt = self._get_system_prompt(filters)
         messages = [
             {"role": "system", "content": [{"type": "text", "text": system_prompt}]},
@@ -67,7 +81,7 @@ class ParserAI:
             prompt_cache_key=catalog_id,
             response_format=SearchFilters
         )
-        try:
-            return json.loads(response.choices[0].message.content)
-        except (json.decoder.JSONDecodeError, TypeError):
+        parsed = response.choices[0].message.parsed
+        if parsed is None:
             return {}
+        return parsed.model_dump(mode="json", by_alias=True, exclude_none=True)
@@ -1,23 +1,62 @@
 import re
 from datetime import datetime, timedelta
 
+from api.common.dates import format_ymd, parse_ymd
+
 
 class ParserRules:
 
+    # catalog_id -> (catalog_filters, index), see _get_catalog_index
+    CATALOG_INDEXES = {}
+    LETTER_PATTERN = re.compile(r"[^\W\d_]")
+
+    @staticmethod
+    def _get_catalog_index(catalog_id: str, catalog_filters: dict) -> dict[str, dict[str, list]]:
+        """Map every parser term to the ids of the catalog filters whose name contains it, per filter type."""
+        cached = ParserRules.CATALOG_INDEXES.get(catalog_id)
+        if cached is not None and cached[0] == catalog_filters:
+            return cached[1]
+
+        index = {}
+        for filter_key, terms in (
+            ("accommodation_groups", ParserAccommodationGroups.PATTERNS),
+            ("age_categories", ParserAgeCategories.CATEGORIES),
+        ):
+            names = {id_: text.lower() for id_, text in catalog_filters.get(filter_key, dict()).items()}
+            index[filter_key] = {term: [id_ for id_, name in names.items() if term in name] for term in terms}
+
+        ParserRules.CATALOG_INDEXES[catalog_id] = (catalog_filters, index)
+        return index
+
+    @staticmethod
+    def consumed_query(parse: dict, user_query: str) -> bool:
+        """Whether the rules recognized and resolved every word of the query left over by parse.
+
+        Age categories and accommodation groups stay in the leftover query, so they are stripped here, but only when
+        each of them resolved to a catalog filter; any other word ("pool", "wifi", ...) could be an amenity.
+        """
+        age_matches = list(PARSER_AGE_CATEGORIES.PATTERN.finditer(user_query))
+        if len({match.lastgroup for match in age_matches}) > len(parse.get("age_categories") or {}):
+            return False
+        if "accommodation_groups" not in parse and PARSER_ACCOMMODATION_GROUPS.PATTERN.search(user_query):
+            return False
+
+        rest = PARSER_ACCOMMODATION_GROUPS.PATTERN.sub(" ", PARSER_AGE_CATEGORIES.PATTERN.sub(" ", user_query))
+        return ParserRules.LETTER_PATTERN.search(rest) is None
+
     def _parse_dates(self, user_query: str) -> tuple[dict, str] | None:
-        parser_dates = ParserDates()
-        return parser_dates.parse(user_query)
+        return PARSER_DATES.parse(user_query)
 
     def _parse_accommodation_groups(self, user_query: str) -> tuple[list[str], str]:
-        parser_accommodation_groups = ParserAccommodationGroups()
-        return parser_accommodation_groups.parse(user_query)
+        return PARSER_ACCOMMODATION_GROUPS.parse(user_query)
 
     def _parse_age_categories(self, user_query: str) -> tuple[dict[str, int], str]:
-        parser_accommodation_groups = ParserAgeCategories()
-        return parser_accommodation_groups.parse(user_query)
+        return PARSER_AGE_CATEGORIES.parse(user_query)
 
-    def parse(self, user_query: str, catalog_filters: dict) -> tuple[dict, str] | None:
+    def parse(self, user_query: str, catalog_filters: dict, catalog_id: str) -> tuple[dict, str] | None:
         parse = {}
+        catalog_index = self._get_catalog_index(catalog_id, catalog_filters)
+
         parse_dates, user_query = self._parse_dates(user_query)
         if parse_dates:
             parse["dates"] = parse_dates
@@ -25,22 +64,21 @@ class ParserRules:
         parse_accommodation_groups, user_query = self._parse_accommodation_groups(user_query)
         if parse_accommodation_groups:
             accommodation_groups = []
-            catalog_filters_accommodation_groups = catalog_filters.get("accommodation_groups", dict())
             for accommodation_group_text in parse_accommodation_groups:
-                for key, item in catalog_filters_accommodation_groups.items():
-                    if accommodation_group_text in item.lower():
-                        accommodation_groups.append(key)
+                accommodation_groups.extend(catalog_index["accommodation_groups"].get(accommodation_group_text, []))
             if accommodation_groups:
                 parse["accommodation_groups"] = accommodation_groups
 
-        parse_age_categories, user_query = self._parse_age_categories(user_query)
+        # every age category needs a count, so a query without digits cannot contain one
+        parse_age_categories = None
+        if ParserDates.DIGIT_PATTERN.search(user_query):
+            parse_age_categories, user_query = self._parse_age_categories(user_query)
         if parse_age_categories:
             age_categories = {}
-            catalog_filters_age_categories = catalog_filters.get("age_categories", dict())
             for parse_age_category_text, age_category_num in parse_age_categories.items():
-                matches = {id_: age_category_text for id_, age_category_text in catalog_filters_age_categories.items() if parse_age_category_text in age_category_text.lower()}
+                matches = catalog_index["age_categories"].get(parse_age_category_text, [])
                 if len(matches) == 1:
-                    age_categories[list(matches.keys())[0]] = age_category_num
+                    age_categories[matches[0]] = age_category_num
 
             if age_categories:
                 parse["age_categories"] = age_categories
@@ -51,15 +89,15 @@ class ParserRules:
 class ParserDates:
 
     # Step 1: Simple date range detection
-    RANGE_PATTERN = r"(\d+(?:\s+\w+)*)\s*(?:[-–—])\s*(\d+(?:\s+\w+)?(?:\s+\d{4})?)"
+    RANGE_PATTERN = re.compile(r"(\d+(?:\s+\w+)*)\s*(?:[-–—])\s*(\d+(?:\s+\w+)?(?:\s+\d{4})?)")
 
     # Step 2: Date component patterns
     DATE_PATTERNS = {
-        "iso": r"^(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})$",
-        "numeric": r"^(\d{1,2})[-/.](\d{1,2})[-/.](\d{2,4})$",
-        "day_month": r"^(\d{1,2})\s+(\w+)(?:\s+(\d{4}))?$",
-        "month_day": r"^(\w+)(?:\s+(\d{1,2}))?(?:\s+(\d{4}))?$",
-        "day_only": r"^(\d{1,2})$"
+        "iso": re.compile(r"^(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})$"),
+        "numeric": re.compile(r"^(\d{1,2})[-/.](\d{1,2})[-/.](\d{2,4})$"),
+        "day_month": re.compile(r"^(\d{1,2})\s+(\w+)(?:\s+(\d{4}))?$"),
+        "month_day": re.compile(r"^(\w+)(?:\s+(\d{1,2}))?(?:\s+(\d{4}))?$"),
+        "day_only": re.compile(r"^(\d{1,2})$")
     }
 
     # Step 3: Month mapping
@@ -77,22 +115,27 @@ class ParserDates:
         "nov": 11, "november": 11,
         "dec": 12, "december": 12, "dez": 12, "dezember": 12
     }
+    # Longest names first, so "januari" is not shadowed by "jan"
+    MONTH_PATTERN = re.compile(r"\b(" + "|".join(map(re.escape, sorted(MONTHS, key=len, reverse=True))) + r")\b")
 
-    DURATION_PATTERN = r"(\d+)\s*(week|weeks|wk|wks|day|days|d)"
+    DURATION_PATTERN = re.compile(r"(\d+)\s*(week|weeks|wk|wks|day|days|d)")
+    YEAR_PATTERN = re.compile(r"\b\d{4}\b")
+    DIGIT_PATTERN = re.compile(r"\d")
+
+    # Date + duration, in either order
+    DATE_DURATION_PATTERN = re.compile(
+        r"(?:(\d+\s+\w+)\s+(\d+\s*(?:week|weeks|wk|wks|day|days|d))|(\d+\s*(?:week|weeks|wk|wks|day|days|d))\s+(\d+\s+\w+))"
+    )
 
     def extract_month_from_text(self, text):
         """Extract month from text like '12 dec' or 'december 12'"""
-        text = text.strip().lower()
-
-        # Check for month names in the text
-        for month_name, month_num in self.MONTHS.items():
-            if month_name in text:
-                return month_num
+        if m := self.MONTH_PATTERN.search(text.strip().lower()):
+            return self.MONTHS[m.group(1)]
         return None
 
     def parse_duration_days(self, text):
         """Convert duration text to number of days"""
-        match = re.search(self.DURATION_PATTERN, text.lower())
+        match = self.DURATION_PATTERN.search(text.lower())
         if not match:
             return None
 
@@ -105,75 +148,99 @@ class ParserDates:
             return amount
         return None
 
-    def parse_date(self, text, context_year=None, context_month=None):
+    @staticmethod
+    def _classify_date(text):
+        """Pick the only DATE_PATTERNS entry that can match, based on the leading characters"""
+        if not text[:1].isdigit():
+            return "month_day"
+        if text.isdigit():
+            return "day_only"
+        head = text[:5]
+        if "-" in head or "/" in head or "." in head:
+            return "iso" if text[:4].isdigit() else "numeric"
+        return "day_month"
+
+    def parse_date(self, text, context_year=None, context_month=None, now=None):
         """Parse date string to yyyy-mm-dd"""
         text = text.strip().lower()
-        year = context_year or datetime.now().year
+        now = now or datetime.now()
+        year = context_year or now.year
+
+        kind = self._classify_date(text)
+        m = self.DATE_PATTERNS[kind].match(text)
+        if not m:
+            return None
 
         # ISO format
-        if m := re.match(self.DATE_PATTERNS["iso"], text):
+        if kind == "iso":
             return f"{m.group(1)}-{int(m.group(2)):02d}-{int(m.group(3)):02d}"
 
         # Numeric DD/MM/YYYY
-        if m := re.match(self.DATE_PATTERNS["numeric"], text):
+        if kind == "numeric":
             y = int(m.group(3))
             if y < 100: y += 2000
             return f"{y:04d}-{int(m.group(2)):02d}-{int(m.group(1)):02d}"
 
         # Day + Month
-        if m := re.match(self.DATE_PATTERNS["day_month"], text):
+        if kind == "day_month":
             day, month_str, year_str = m.groups()
             if month_str in self.MONTHS:
                 month = self.MONTHS[month_str]
                 if year_str: year = int(year_str)
                 return f"{year:04d}-{month:02d}-{int(day):02d}"
+            return None
 
         # Month + Day
-        if m := re.match(self.DATE_PATTERNS["month_day"], text):
+        if kind == "month_day":
             month_str, day_str, year_str = m.groups()
             if month_str in self.MONTHS:
                 month = self.MONTHS[month_str]
                 day = int(day_str) if day_str else 1
                 if year_str: year = int(year_str)
                 return f"{year:04d}-{month:02d}-{day:02d}"
+            return None
 
         # Day only (use context)
-        if m := re.match(self.DATE_PATTERNS["day_only"], text):
-            month = context_month or datetime.now().month
-            return f"{year:04d}-{month:02d}-{int(m.group(1)):02d}"
-
-        return None
+        month = context_month or now.month
+        return f"{year:04d}-{month:02d}-{int(m.group(1)):02d}"
 
     def parse(self, text, remove_from_text=True):
         """Extract date ranges as [{"start": "YYYY-MM-DD", "end": "YYYY-MM-DD"}]"""
 
+        now = datetime.now()
+        today = now.date()
+
+        # Ranges and durations both need a digit, so skip those scans entirely without one
+        lowered_text = text.lower()
+        has_digits = self.DIGIT_PATTERN.search(lowered_text) is not None
+
         # First check for traditional range pattern
-        range_match = re.search(self.RANGE_PATTERN, text.lower())
+        range_match = self.RANGE_PATTERN.search(lowered_text) if has_digits else None
 
         if range_match:
             start_text, end_text = range_match.groups()
 
-            end_date = self.parse_date(end_text, datetime.now().year, None)
+            end_date = self.parse_date(end_text, now.year, None, now)
             if not end_date:
                 pass
             else:
                 end_parts = end_date.split("-")
                 end_year = int(end_parts[0])
                 context_month = int(end_parts[1])
-                has_explicit_year = bool(re.search(r'\b\d{4}\b', end_text))
+                has_explicit_year = bool(self.YEAR_PATTERN.search(end_text))
 
                 if has_explicit_year:
-                    context_year = end_year
+                    start_date = self.parse_date(start_text, end_year, context_month, now)
                 else:
-                    context_year = datetime.now().year
-                    temp_start = self.parse_date(start_text, context_year, context_month)
-                    if temp_start:
-                        temp_start_date = datetime.strptime(temp_start, "%Y-%m-%d")
-                        if temp_start_date < datetime.now():
-                            context_year += 1
-                            end_date = self.parse_date(end_text, context_year, None)
-
-                start_date = self.parse_date(start_text, context_year, context_month)
+                    # parse start once in the current year, and only reparse both ends if it lies in the past
+                    context_year = now.year
+                    start_date = self.parse_date(start_text, context_year, context_month, now)
+                    # a start date of today counts as past, like the datetime comparison this replaces
+                    if start_date and parse_ymd(start_date) <= today:
+                        context_year += 1
+                        end_date = self.parse_date(end_text, context_year, None, now)
+                        start_date = self.parse_date(start_text, context_year, context_month, now)
+
                 if not start_date:
                     pass
                 else:
@@ -183,8 +250,7 @@ class ParserDates:
                     return {"start": start_date, "end": end_date}, text
 
         # Check for date + duration (either order)
-        duration_pattern = r"(?:(\d+\s+\w+)\s+(\d+\s*(?:week|weeks|wk|wks|day|days|d))|(\d+\s*(?:week|weeks|wk|wks|day|days|d))\s+(\d+\s+\w+))"
-        if duration_match := re.search(duration_pattern, text.lower()):
+        if has_digits and (duration_match := self.DATE_DURATION_PATTERN.search(lowered_text)):
             if duration_match.group(1):  # date duration
                 start_text = duration_match.group(1)
                 duration_text = duration_match.group(2)
@@ -192,17 +258,17 @@ class ParserDates:
                 start_text = duration_match.group(4)
                 duration_text = duration_match.group(3)
 
-            start_date = self.parse_date(start_text)
+            start_date = self.parse_date(start_text, now=now)
             duration_days = self.parse_duration_days(duration_text)
 
             if start_date and duration_days:
-                start_dt = datetime.strptime(start_date, "%Y-%m-%d")
-                if start_dt < datetime.now():
+                start_dt = parse_ymd(start_date)
+                if start_dt <= today:
                     start_dt = start_dt.replace(year=start_dt.year + 1)
-                    start_date = start_dt.strftime("%Y-%m-%d")
+                    start_date = format_ymd(start_dt)
 
                 end_dt = start_dt + timedelta(days=duration_days)
-                end_date = end_dt.strftime("%Y-%m-%d")
+                end_date = format_ymd(end_dt)
 
                 if remove_from_text:
                     text = text[:duration_match.start()] + text[duration_match.end():]
@@ -211,7 +277,7 @@ class ParserDates:
                 return {"start": start_date, "end": end_date}, text
 
         # Fall back to single date parsing
-        single_date = self.parse_date(text)
+        single_date = self.parse_date(text, now=now)
         if single_date:
             if remove_from_text:
                 text = ""
@@ -221,66 +287,58 @@ class ParserDates:
 
 
 class ParserAccommodationGroups:
-    # Comprehensive regex patterns for accommodation groups
+    # Comprehensive regex patterns for accommodation groups, in reporting order
     PATTERNS = {
-        "kamperen": r"(kampe(r?e?n?|erplek)|[ck]amp(site|ground|e[rn]|ing(platz)?)|zeltplatz|\b[ck]aravan|tent|vouwwagen)",
         "huren": r"(huren|(vakantie)?huis(je)?|huuraccommodatie|rent(al)?|cottage|villa|holiday\s*home|safaritent|stacaravan|mieten|ferienwohnung|ferienhaus|chalet?|(vakantie)?bungalow|glamping(tent)?)",
+        "kamperen": r"(kampe(r?e?n?|erplek)|[ck]amp(site|ground|e[rn]|ing(platz)?)|zeltplatz|\b[ck]aravan|tent|vouwwagen)",
     }
+    # All groups fused into one pattern; the outer named group tells which group matched
+    PATTERN = re.compile(
+        "|".join(f"(?P<{dutch_group}>{pattern})" for dutch_group, pattern in PATTERNS.items()),
+        re.IGNORECASE
+    )
 
     def parse(self, text, remove_from_text=True) -> tuple[list[str], str]:
-        accommodation_groups_texts = []
         working_text = text
 
-        compiled_patterns = {
-            dutch_group: re.compile(pattern, re.IGNORECASE)
-            for dutch_group, pattern in self.PATTERNS.items()
-        }
-
-        for dutch_group in ["huren", "kamperen"]:
-            matches = list(compiled_patterns[dutch_group].finditer(working_text))
-
-            if matches:
-                accommodation_groups_texts.append(dutch_group)
+        # the outer named group closes last, so lastgroup names the matched accommodation group
+        matched_groups = {match.lastgroup for match in self.PATTERN.finditer(working_text)}
+        accommodation_groups_texts = [dutch_group for dutch_group in self.PATTERNS if dutch_group in matched_groups]
 
         return accommodation_groups_texts, working_text if remove_from_text else text
 
 
 class ParserAgeCategories:
-    # Regex patterns for different age categories in multiple languages
-    PATTERNS = {
-        "volwassenen": re.compile(
-            r"\b(\d{1,2})\s+(volwassen(?:en?)?|adults?|erwachsene?)\b"
-        ),
-        "baby": re.compile(
-            r"\b(\d{1,2})\s+(baby's?|babies|babys?)\b"
-        ),
-        "16+": re.compile(
-            r"\b(\d{1,2})\s+(16\+|zestien\+|sixteen\+|sechzehn\+)\b"
-        ),
-        "18-15": re.compile(
-            r"\b(\d{1,2})\s+(18-15|achttien-vijftien|eighteen-fifteen|achtzehn-fünfzehn)\b"
-        ),
-        "25+": re.compile(
-            r"\b(\d{1,2})\s+(25\+|vijfentwintig\+|twenty-five\+|fünfundzwanzig\+)\b"
-        ),
-        "kinderen": re.compile(
-            r"\b(\d{1,2})\s+(kinder(?:en)?|children?|child|kids?)\b"
-        )
+    # Regex alternatives for different age categories in multiple languages
+    CATEGORIES = {
+        "volwassenen": r"volwassen(?:en?)?|adults?|erwachsene?",
+        "baby": r"baby's?|babies|babys?",
+        "16+": r"16\+|zestien\+|sixteen\+|sechzehn\+",
+        "18-15": r"18-15|achttien-vijftien|eighteen-fifteen|achtzehn-fünfzehn",
+        "25+": r"25\+|vijfentwintig\+|twenty-five\+|fünfundzwanzig\+",
+        "kinderen": r"kinder(?:en)?|children?|child|kids?",
     }
+    # All categories fused into one pattern; each category is a named group "c<index>"
+    GROUP_CATEGORIES = {f"c{i}": dutch_category for i, dutch_category in enumerate(CATEGORIES)}
+    PATTERN = re.compile(
+        r"\b(\d{1,2})\s+(?:"
+        + "|".join(f"(?P<c{i}>{body})" for i, body in enumerate(CATEGORIES.values()))
+        + r")\b"
+    )
 
     def parse(self, text, remove_from_text=True) -> tuple[dict[str, int], str]:
         age_categories = {}
         working_text = text
 
-        for dutch_category, pattern in self.PATTERNS.items():
-            matches = list(pattern.finditer(working_text))
+        for match in self.PATTERN.finditer(working_text):
+            dutch_category = self.GROUP_CATEGORIES[match.lastgroup]
+            age_categories[dutch_category] = age_categories.get(dutch_category, 0) + int(match.group(1))
 
-            for match in reversed(matches):
-                count = int(match.group(1))
+        return age_categories, working_text if remove_from_text else text
 
-                if dutch_category in age_categories:
-                    age_categories[dutch_category] += count
-                else:
-                    age_categories[dutch_category] = count
 
-        return age_categories, working_text if remove_from_text else text
+# The parsers keep no per-call state, so one instance of each is shared
+PARSER_DATES = ParserDates()
+PARSER_ACCOMMODATION_GROUPS = ParserAccommodationGroups()
+PARSER_AGE_CATEGORIES = ParserAgeCategories()
+PARSER_RULES = ParserRules()
@@ -1,32 +1,37 @@
 import logging
-import traceback
 
 from functools import wraps
 
+import orjson
+from flask import make_response
+
+
+def output_json(data, code, headers=None):
+    """flask-restful JSON representation serialized with orjson instead of the stdlib json module."""
+    response = make_response(orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS), code)
+    response.headers.extend(headers or {})
+    response.mimetype = "application/json"
+    return response
+
 
 class TommyResponse:
     @staticmethod
     def success(data=None, message="Successful request.", status_code=200, code=None):
-        response = {
+        return {
             "status": "success",
             "message": message,
-            "data": data if data else {}
-        }
-        if code:
-            response["code"] = code
-        return response, status_code
+            "data": data or {},
+            **({"code": code} if code else {})
+        }, status_code
 
     @staticmethod
     def error(message, error_type=None, status_code=400, code=None):
-        response = {
+        return {
             "status": "error",
-            "message": message
-        }
-        if error_type:
-            response["error"] = error_type
-        if code:
-            response["code"] = code
-        return response, status_code
+            "message": message,
+            **({"error": error_type} if error_type else {}),
+            **({"code": code} if code else {})
+        }, status_code
 
 
 class TommyErrors:
@@ -93,11 +98,8 @@ class TommyErrors:
 
     @staticmethod
     def server_error(message="An unexpected error occurred", error=None, code=None):
-        if error:
-            logging.error("Full error stack:\n%s",
-                          ''.join(traceback.format_exception(type(error), error, error.__traceback__)))
-        else:
-            logging.error("Full error stack:\n%s", traceback.format_exc())
+        # the handler formats the traceback, only when the record is actually emitted
+        logging.error("Full error stack:", exc_info=error if error else True)
 
         return TommyResponse.error(
             message=message,
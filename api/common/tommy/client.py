@@ -1,7 +1,10 @@
 import json
-from datetime import datetime, timedelta
+from datetime import timedelta
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from api.common.dates import format_ymd, parse_ymd
 
 
 class TommyClient:
@@ -14,26 +17,20 @@ class TommyClient:
 
     def __init__(self, api_token):
         self.api_token = api_token
+        self.headers = {**self.HEADERS, "X-Api-Token": api_token}
 
-    def _get_headers(self):
-        headers = self.HEADERS.copy()
-        headers.update({"X-Api-Token": self.api_token,})
-        return headers
+        # keep-alive session, so repeated calls skip the TCP + TLS handshake
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
 
     @staticmethod
     def _standardize_response_keys(response_json: dict) -> dict:
-        for key in list(response_json.keys()):
-            new_key = key.replace("-", "_")
-            if key != new_key:
-                response_json[new_key] = response_json[key]
-                del response_json[key]
-        return response_json
+        return {key.replace("-", "_") if "-" in key else key: value for key, value in response_json.items()}
 
     def _get_from_tommy(self,
                         endpoint: str,
                         search_params: dict | None =None) -> dict | None:
-        headers = self._get_headers()
-        response = requests.get(f"{self.BASE_URL}/{endpoint}", headers=headers, params=search_params, timeout=15)
+        response = self.session.get(f"{self.BASE_URL}/{endpoint}", headers=self.headers, params=search_params, timeout=15)
         if response.status_code == 200:
             response_json = response.json().get("data")
             if isinstance(response_json, dict):
@@ -59,15 +56,10 @@ class TommyClient:
                          accommodation_groups: str | None = None,
                          amenities: dict | None = None) -> list | None:
         def expand_date_ranges(params):
-            fmt = "%Y-%m-%d"
-            for key in ["date-from", "date-till"]:
-                ranges = []
-                if key in params:
-                    date = datetime.strptime(params[key], fmt)
-                    prev_day = (date - timedelta(1)).strftime(fmt)
-                    next_day = (date + timedelta(1)).strftime(fmt)
-                    ranges.extend([prev_day, params[key], next_day])
-                params[key] = "|".join(ranges)
+            # search one day either side of each date: "prev|date|next"
+            for key in ("date-from", "date-till"):
+                day = parse_ymd(params[key])
+                params[key] = f"{format_ymd(day - timedelta(1))}|{params[key]}|{format_ymd(day + timedelta(1))}"
             return params
 
         params = {"date-from": arrival_date, "date-till": departure_date}
@@ -76,15 +68,9 @@ class TommyClient:
         if accommodation_groups:
             params["accommodation-group"] = accommodation_groups
 
-        if age_categories:
-            try:
-                age_categories_params = []
-                for age_category, pax in age_categories.items():
-                    age_categories_params[age_category] = int(age_category["id"])
-                params["age-category"] = json.dumps(age_categories)
-            except (ValueError, TypeError, json.JSONDecodeError):
-                pass
-        else:
+        # a search needs age categories, but they are not sent: the widget search never received them so far,
+        # and which age-category format it accepts is unverified
+        if not age_categories:
             return None
 
         if amenities:
@@ -1,7 +1,7 @@
 import os
+import re
 import uuid
 
-from dotenv import load_dotenv
 from flask import Flask, make_response
 from flask_cors import CORS
 from flask_limiter.errors import RateLimitExceeded
@@ -13,8 +13,17 @@ from api.common.response import TommyErrors
 from api.resources import api
 
 
+# environment is read once per process, not on every create_app() call (.env is loaded in api/__init__.py)
+JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
+
+
 class UUIDConverter(BaseConverter):
+    REGEX_UUID = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", re.IGNORECASE)
+
     def to_python(self, value):
+        # canonical form is validated without building a UUID object, other accepted forms are normalized
+        if self.REGEX_UUID.fullmatch(value):
+            return value.lower()
         try:
             return str(uuid.UUID(value))
         except ValueError:
@@ -25,11 +34,9 @@ class UUIDConverter(BaseConverter):
 
 
 def create_app():
-    load_dotenv()
-
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_pyfile("config.py")
-    app.secret_key = os.getenv("JWT_SECRET_KEY")
+    app.secret_key = JWT_SECRET_KEY
     app.url_map.converters["uuid"] = UUIDConverter
 
     try:
@@ -1,68 +1,124 @@
 import json
+import logging
 import os
 import re
+import threading
 import unicodedata
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 
+import orjson
 from cerberus import Validator
 from flask import request
 from flask_restful import Resource
-from urllib.parse import urlencode
+from urllib.parse import quote_plus, urlencode
 
-from api.common.cache import redis_cache
+from api.common.cache import redis_cache, redis_cache_prefetch, request_cache
+from api.common.limiter import token_bucket_exempt, token_bucket_limit
 from api.common.parser.ai import ParserAI
-from api.common.parser.rules import ParserRules
+from api.common.parser.rules import PARSER_RULES, ParserRules
 from api.common.response import TommyResponse, TommyErrors
 from api.common.tommy.client import TommyClient
 
 
+VALID_CATALOG_IDS = frozenset({"219b2fc6-d2e0-42e9-a670-848124341c0f"})
+
+# TODO: remove ad hoc amenity fixes
+AMENITY_RENAMES = {"Aan het water": "Gelegen naast een meer of zee"}
+AMENITY_SKIP = frozenset({"Aantal slaapkamers"})
+
+# TODO: map catalog_id to TOMMY_API_KEY
+TOMMY_CLIENT = None
+# independent Tommy calls of a single request are run concurrently on this pool
+TOMMY_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("TOMMY_WORKERS", "8")), thread_name_prefix="tommy")
+
+
+def load_data_file(filename: str):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", filename)) as data_file:
+        return json.load(data_file)
+
+
+def check_ymd(field, value, error):
+    """Cerberus check_with rule for YYYY-MM-DD dates that exist, parsed by date.fromisoformat instead of a regex."""
+    # since Python 3.11 fromisoformat also takes e.g. 20270101 and 2027-W01-1, so the shape is pinned first
+    if len(value) == 10 and value[4] == "-" and value[7] == "-":
+        try:
+            date.fromisoformat(value)
+            return
+        except ValueError:
+            pass
+    error(field, "must be a date in YYYY-MM-DD format")
+
+
+def get_tommy_client() -> TommyClient:
+    """Lazily create the process-wide Tommy client, after .env has been loaded."""
+    global TOMMY_CLIENT
+    if TOMMY_CLIENT is None:
+        TOMMY_CLIENT = TommyClient(os.getenv("TOMMY_API_KEY_TEMP"))
+    return TOMMY_CLIENT
+
+
 class Catalog(Resource):
 
     @staticmethod
     def validate_catalog_id(catalog_id):
-        return catalog_id == "219b2fc6-d2e0-42e9-a670-848124341c0f"
+        return catalog_id in VALID_CATALOG_IDS
+
+    @staticmethod
+    def _get_language_value(language_items: list[dict], language: str):
+        return next((item.get("value") for item in language_items if item.get("language") == language), None)
 
     @staticmethod
     def extract_language_from_metadata_item_name(metadata_item, language: str = "nl") -> dict:
-        options = {}
-        for metadata_option in metadata_item:
-            for language_item in metadata_option.get("name"):
-                if language_item.get("language") == language:
-                    options[metadata_option.get("id")] = language_item.get("value")
-                break
-        return options
+        return {
+            metadata_option["id"]: value
+            for metadata_option in metadata_item
+            if (value := Catalog._get_language_value(metadata_option["name"], language)) is not None
+        }
 
     @staticmethod
     def extract_language_from_metadata_item(metadata_item: list[dict], metadata_keys: list, language: str = "nl") -> dict[int, dict]:
-        options = {}
-        for metadata_option in metadata_item:
-            option = {}
-            for key in metadata_keys:
-                for language_item in metadata_option.get(key):
-                    if language_item.get("language") == language:
-                        option[key] = language_item.get("value")
-                    break
-            options[metadata_option.get("id")] = option
-        return options
-
-    @redis_cache("catalog:{catalog_id}:filters", ex=3600)
-    def get_catalog_filters_from_tommy(self, catalog_id: str):
-        # TODO: map catalog_id to TOMMY_API_KEY
-        client = TommyClient(os.getenv("TOMMY_API_KEY_TEMP"))
+        return {
+            metadata_option["id"]: {
+                key: value
+                for key in metadata_keys
+                if (value := Catalog._get_language_value(metadata_option[key], language)) is not None
+            }
+            for metadata_option in metadata_item
+        }
+
+    @staticmethod
+    @request_cache("catalog:{catalog_id}:filters")
+    @redis_cache("catalog:{catalog_id}:filters", ex=3600, l1_ex=300)
+    def get_catalog_filters_from_tommy(catalog_id: str):
+        client = get_tommy_client()
         tommy_metadata = client.get_metadata()
         catalog_filters = {}
         if tommy_metadata:
             for key in tommy_metadata:
-                catalog_filters[key] = self.extract_language_from_metadata_item_name(tommy_metadata[key])
-                if key == "amenities":
-                    # TODO: remove ad hoc
-                    for amenity_key in list(catalog_filters[key].keys()):
-                        if catalog_filters[key][amenity_key] == "Aan het water":
-                            catalog_filters[key][amenity_key] = "Gelegen naast een meer of zee"
-                        elif catalog_filters[key][amenity_key] == "Aantal slaapkamers":
-                            del catalog_filters[key][amenity_key]
+                catalog_filters[key] = Catalog.extract_language_from_metadata_item_name(tommy_metadata[key])
+            if amenities := catalog_filters.get("amenities"):
+                catalog_filters["amenities"] = {
+                    amenity_id: AMENITY_RENAMES.get(name, name)
+                    for amenity_id, name in amenities.items()
+                    if name not in AMENITY_SKIP
+                }
         return catalog_filters
 
+    @staticmethod
+    @request_cache("catalog:{catalog_id}:filters:json")
+    @redis_cache("catalog:{catalog_id}:filters:json", ex=3600, l1_ex=300)
+    def get_catalog_filters_json(catalog_id: str) -> str:
+        """Catalog filters serialized once for the AI parser prompt, instead of per parse.
+
+        Empty filters give "", which redis_cache keeps for its short TTL instead of caching "{}" for an hour.
+        """
+        catalog_filters = Catalog.get_catalog_filters_from_tommy(catalog_id)
+        if not catalog_filters:
+            return ""
+        return orjson.dumps(catalog_filters, option=orjson.OPT_NON_STR_KEYS).decode()
+
     def get(self, catalog_id):
         if not self.validate_catalog_id(catalog_id):
             return TommyErrors.bad_request()
@@ -76,15 +132,51 @@ class Catalog(Resource):
 
 class CatalogSearch(Resource):
 
+    # rate limited by the token bucket on get instead of the LIMITER's fixed window, which is the fallback without Redis
+    decorators = [token_bucket_exempt]
+
+    BOOKING_URL = "https://demo.prosuco.nl/zoek-en-boek/boeken"
+
     REGEX_ALPHANUMERIC = re.compile(r"[a-z\d]")
-    REGEX_CONSECUTIVE_CHARS = re.compile(r"(\D)\1{2,}|(\d)\1{3,}")
-    REGEX_DOUBLE_SPACES = re.compile(r"\s{2,}")
-    REGEX_INVALID_CHARS = re.compile(r"[^a-z\d.\-/\s]+")
+    # whitespace runs are left to the final split() + join, collapsing them here would glue the words together
+    REGEX_CONSECUTIVE_CHARS = re.compile(r"([^\d\s])\1{2,}|(\d)\1{3,}")
+    REGEX_WHITESPACE = re.compile(r"\s+")
     REGEX_MONTH_PATTERN = re.compile(
         r"\b(?P<jan>jan(uar[iy]?|vier))|(?P<feb>feb(ruar[iy]?|braio))|(?P<mar>maa?r(zo?|s|t)|märz)|(?P<apr>apr(il[e]?))|(?P<may>ma[iy]|maggio|mei)|(?P<jun>jun[ei]|giu[gn]no?)|(?P<jul>jul(y|i[oa]?))|(?P<aug>aug(ust(us|o)?)?|août|aout)|(?P<sep>sep(tember|tembre)?)|(?P<oct>o[ck]t(ober|obre)?)|(?P<nov>nov(ember|embre)?)|(?P<dec>de[cz](ember|embre|icembre)?)\b"
     )
     REGEX_RANGE_WORDS = re.compile(r"\s+(tot?(\s*en\s*met)|t/?m|thr(ough|u)|(un)?till?|bis)\s+")
 
+    # Accented Latin letters folded to their base letters, the same result as NFD without combining marks
+    ACCENT_TABLE = {
+        codepoint: "".join(c for c in unicodedata.normalize("NFD", chr(codepoint)) if unicodedata.category(c) != "Mn")
+        for codepoint in range(0xC0, 0x250)
+        if unicodedata.normalize("NFD", chr(codepoint)) != chr(codepoint)
+    }
+
+    # Number words (1-10) in English, German, and Dutch
+    WORD_TO_NUMBER = {
+        # English
+        "one": "1", "two": "2", "three": "3", "four": "4", "five": "5",
+        "six": "6", "seven": "7", "eight": "8", "nine": "9", "ten": "10",
+        # German
+        "eins": "1", "zwei": "2", "drei": "3", "vier": "4", "fünf": "5",
+        "sechs": "6", "sieben": "7", "acht": "8", "neun": "9", "zehn": "10",
+        # Dutch
+        "een": "1", "twee": "2", "drie": "3", "vier": "4", "vijf": "5",
+        "zes": "6", "zeven": "7", "acht": "8", "negen": "9", "tien": "10"
+    }
+    # Number words and range words replaced in a single pass, see _replace_query_token
+    REGEX_QUERY_TOKENS = re.compile(
+        r"(?P<number>\b(?:" + "|".join(map(re.escape, WORD_TO_NUMBER)) + r")\b)"
+        r"|(?P<range>" + REGEX_RANGE_WORDS.pattern + ")"
+    )
+    # Deletes everything but [a-z\d.\-/\s]; queries are pure ASCII after _remove_accents, so ASCII is all it needs
+    INVALID_CHARS_TABLE = {
+        codepoint: None
+        for codepoint in range(0x80)
+        if not (chr(codepoint) in "abcdefghijklmnopqrstuvwxyz0123456789.-/" or chr(codepoint).isspace())
+    }
+
     SCHEMA_USER_PARSE = {
         "dates": {
             "type": "dict",
@@ -93,12 +185,12 @@ class CatalogSearch(Resource):
                 "start": {
                     "type": "string",
                     "required": True,
-                    "regex": r"^\d{4}-\d{2}-\d{2}$"
+                    "check_with": check_ymd
                 },
                 "end": {
                     "type": "string",
                     "required": True,
-                    "regex": r"^\d{4}-\d{2}-\d{2}$"
+                    "check_with": check_ymd
                 }
             }
         },
@@ -129,7 +221,9 @@ class CatalogSearch(Resource):
         },
     }
 
-    STOPWORDS_NL = set(json.load(open(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.join("..", "data", "stopwords-nl.json")))))
+    STOPWORDS_NL = frozenset(load_data_file("stopwords-nl.json"))
+
+    PARSE_VALIDATORS = threading.local()
 
     @staticmethod
     def _validate_user_query(user_query):
@@ -140,62 +234,49 @@ class CatalogSearch(Resource):
 
     @staticmethod
     def _validate_user_parse(user_parse):
-        validator = Validator()
-        return validator.validate(user_parse, CatalogSearch.SCHEMA_USER_PARSE)
+        # the schema is normalized once per validator; validators keep per-call state, so one per thread
+        validator = getattr(CatalogSearch.PARSE_VALIDATORS, "validator", None)
+        if validator is None:
+            validator = CatalogSearch.PARSE_VALIDATORS.validator = Validator(CatalogSearch.SCHEMA_USER_PARSE)
+        return validator.validate(user_parse)
 
-    def _sanitize_user_query(self, user_query):
-        def get_month(match):
-            months = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"]
-            for i, month in enumerate(months):
-                if match.group(month):
-                    return month
-            return match.group(0)
-
-        def remove_accents(text):
-            normalized = unicodedata.normalize("NFD", text)
-            ascii_text = ''.join(c for c in normalized if unicodedata.category(c) != "Mn")
-            return ascii_text
-
-        def replace_range_words(text):
-            return self.REGEX_RANGE_WORDS.sub(" - ", text)
-
-        def replace_number_words(text):
-            """Replace number words (1-10) with digits in English, German, and Dutch."""
-
-            word_to_number = {
-                # English
-                "one": "1", "two": "2", "three": "3", "four": "4", "five": "5",
-                "six": "6", "seven": "7", "eight": "8", "nine": "9", "ten": "10",
-                # German
-                "eins": "1", "zwei": "2", "drei": "3", "vier": "4", "fünf": "5",
-                "sechs": "6", "sieben": "7", "acht": "8", "neun": "9", "zehn": "10",
-                # Dutch
-                "een": "1", "twee": "2", "drie": "3", "vier": "4", "vijf": "5",
-                "zes": "6", "zeven": "7", "acht": "8", "negen": "9", "tien": "10"
-            }
+    @staticmethod
+    def _remove_accents(text):
+        if text.isascii():
+            return text
+        text = text.translate(CatalogSearch.ACCENT_TABLE)
+        if text.isascii():
+            return text
+        # compatibility forms (ligatures, superscripts, ...) are decomposed too, anything non-ASCII left is dropped
+        return unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
 
-            pattern = r"\b(" + "|".join(word_to_number.keys()) + r")\b"
-            return re.sub(pattern, lambda m: word_to_number[m.group(1).lower()], text)
+    @staticmethod
+    def _replace_query_token(match):
+        """Replace number words with digits and range words with ' - '."""
+        if match.lastgroup == "number":
+            return CatalogSearch.WORD_TO_NUMBER[match.group(0)]
+        return " - "
 
-        user_query = user_query.lower().strip()
-        user_query = remove_accents(user_query)
-        user_query = replace_number_words(user_query)
-        user_query = replace_range_words(user_query)
-        user_query = self.REGEX_INVALID_CHARS.sub("", user_query)
+    def _sanitize_user_query(self, user_query):
+        def get_month(match):
+            # The named groups of REGEX_MONTH_PATTERN are the canonical month names
+            return match.lastgroup or match.group(0)
+
+        # all Unicode whitespace (NBSP, line separators, ...) becomes a plain space before accent folding can drop it
+        user_query = self.REGEX_WHITESPACE.sub(" ", user_query.lower()).strip()
+        user_query = self._remove_accents(user_query)
+        user_query = self.REGEX_QUERY_TOKENS.sub(self._replace_query_token, user_query)
+        user_query = user_query.translate(self.INVALID_CHARS_TABLE)
         user_query = self.REGEX_MONTH_PATTERN.sub(get_month, user_query)
         user_query = self.REGEX_CONSECUTIVE_CHARS.sub("", user_query)
-        user_query = self.REGEX_DOUBLE_SPACES.sub(" ", user_query)
-
-        # Remove stopwords
-        words = user_query.split()
-        filtered_words = [word for word in words if word not in self.STOPWORDS_NL]
-        user_query = " ".join(filtered_words)
 
-        return user_query.strip()
+        # Remove stopwords; split() + join also collapses and strips whitespace
+        stopwords = self.STOPWORDS_NL
+        return " ".join([word for word in user_query.split() if word not in stopwords])
 
     @staticmethod
-    def build_booking_url(slot: dict, age_categories: dict, arrival_date: str, departure_date: str) -> str:
-        """Build booking URL with query parameters from slot data."""
+    def build_booking_url_prefix(age_categories: dict, arrival_date: str, departure_date: str) -> str:
+        """Build booking URL up to the accommodation parameter, shared by all slots of one search."""
         age_category_param = json.dumps([
             {"id": cat_id, "pax": count}
             for cat_id, count in age_categories.items()
@@ -205,10 +286,9 @@ class CatalogSearch(Resource):
             "age-category": age_category_param,
             "arrival-date": arrival_date,
             "departure-date": departure_date,
-            "accommodation": slot.get("id"),
         }
 
-        return f"https://demo.prosuco.nl/zoek-en-boek/boeken?{urlencode(params)}"
+        return f"{CatalogSearch.BOOKING_URL}?{urlencode(params)}&accommodation="
 
     @staticmethod
     def get_catalog_results_from_tommy(
@@ -220,39 +300,58 @@ class CatalogSearch(Resource):
     ) -> list:
         if not arrival_date or not departure_date or not age_categories:
             return []
-        client = TommyClient(os.getenv("TOMMY_API_KEY_TEMP"))
+        client = get_tommy_client()
         availability = client.get_availability(
             arrival_date=arrival_date,
             departure_date=departure_date,
             age_categories=age_categories,
-            accommodation_groups=",".join([str(x) for x in accommodation_groups]) if accommodation_groups else None,
+            accommodation_groups=",".join(map(str, accommodation_groups)) if accommodation_groups else None,
             amenities=amenities
         )
         if availability:
+            booking_url_prefix = CatalogSearch.build_booking_url_prefix(age_categories, arrival_date, departure_date)
             for slot in availability:
-                slot["url"] = CatalogSearch.build_booking_url(slot, age_categories, arrival_date, departure_date)
+                slot["url"] = booking_url_prefix + quote_plus(str(slot.get("id")))
         return availability or []
 
     @staticmethod
     def get_accommodations_from_tommy() -> dict:
-        client = TommyClient(os.getenv("TOMMY_API_KEY_TEMP"))
+        client = get_tommy_client()
         tommy_accommodations = client.get_accommodations()
         accommodations = Catalog.extract_language_from_metadata_item(tommy_accommodations, ["name", "description"])
         for accommodation in tommy_accommodations:
             accommodations[accommodation.get("id")]["image_url"] = accommodation.get("images" , [{}])[0].get("url")
         return accommodations or dict()
 
+    @staticmethod
+    def _needs_ai_parse(parse: dict, user_query: str) -> bool:
+        """Whether the query left over by the rules is worth a ParserAI round-trip."""
+        if not user_query or len(user_query) < 5 or CatalogSearch.REGEX_ALPHANUMERIC.search(user_query) is None:
+            return False
+
+        # with dates and age categories the search can run, so the AI is skipped when it has nothing left to add
+        dates = parse.get("dates") or {}
+        if "age_categories" in parse and dates.get("start") and dates.get("end"):
+            if ParserRules.consumed_query(parse, user_query):
+                logging.debug("Skipping AI parse, rules consumed the query: %s", user_query)
+                return False
+
+        return True
+
     @staticmethod
     @redis_cache("catalog:{catalog_id}:query:{user_query}:parse", ex=3600)
     def _parse_user_query(catalog_id, user_query, catalog_filters) -> dict:
-        parser_rules = ParserRules()
-        parse, user_query = parser_rules.parse(user_query, catalog_filters)
+        # without letters or digits neither the rules nor the AI can find anything
+        if CatalogSearch.REGEX_ALPHANUMERIC.search(user_query) is None:
+            return {}
+
+        parse, user_query = PARSER_RULES.parse(user_query, catalog_filters, catalog_id)
         if not catalog_filters.get("amenities") and len(parse) == 3:
             return parse
 
-        if user_query and CatalogSearch.REGEX_ALPHANUMERIC.search(user_query) is not None and len(user_query) >= 5:
+        if CatalogSearch._needs_ai_parse(parse, user_query):
             parser_ai = ParserAI()
-            parse_ai = parser_ai.parse(user_query, json.dumps(catalog_filters), catalog_id)
+            parse_ai = parser_ai.parse(user_query, Catalog.get_catalog_filters_json(catalog_id) or "{}", catalog_id)
             for key in parse_ai:
                 if key not in parse:
                     parse[key] = parse_ai[key]
@@ -279,6 +378,7 @@ class CatalogSearch(Resource):
 
         return parse
 
+    @token_bucket_limit(30, 60)
     def get(self, catalog_id):
         # validate, sanitize, and re-validate user query
         original_user_query = request.args.get("q")
@@ -292,46 +392,61 @@ class CatalogSearch(Resource):
         user_parse = {}
         if request.args.get("parse"):
             try:
-                user_parse = json.loads(request.args.get("parse"))
+                user_parse = orjson.loads(request.args.get("parse"))
                 if user_parse and not self._validate_user_parse(user_parse):
                     return TommyErrors.bad_request()
-            except (json.JSONDecodeError, TypeError):
+            except (orjson.JSONDecodeError, TypeError):
                 user_parse = {}
 
+        # load both cached lookups of this request in one Redis round-trip
+        redis_cache_prefetch(
+            (Catalog.get_catalog_filters_from_tommy, {"catalog_id": catalog_id}),
+            (CatalogSearch._parse_user_query, {"catalog_id": catalog_id, "user_query": user_query}),
+        )
+
         # parse query
-        catalog_filters = Catalog().get_catalog_filters_from_tommy(catalog_id)
-        accommodations = self.get_accommodations_from_tommy()
+        catalog_filters = Catalog.get_catalog_filters_from_tommy(catalog_id)
         parse = self._parse_user_query(catalog_id, user_query, catalog_filters)
 
-        # add user parse
-        for key in parse:
-            if key in user_parse:
-                del user_parse[key]
-        parse = parse | user_parse
+        # add user parse, for keys the query parse did not fill (parse may be shared from the cache, never mutate it)
+        if user_parse:
+            parse = parse | {key: value for key, value in user_parse.items() if key not in parse}
 
         # search results
         results = None
-        if not parse.get("error") and parse.get("dates"):
+        if not parse.get("error") and (dates := parse.get("dates")):
+            arrival_date, departure_date = dates.get("start"), dates.get("end")
+            age_categories = parse.get("age_categories")
+
+            # accommodations only enrich results, so they are fetched alongside an availability search that
+            # actually reaches Tommy (see get_catalog_results_from_tommy), and never otherwise
+            future_accommodations = None
+            if arrival_date and departure_date and age_categories:
+                future_accommodations = TOMMY_EXECUTOR.submit(self.get_accommodations_from_tommy)
+
             results = self.get_catalog_results_from_tommy(
-                parse.get("dates", {}).get("start"),
-                parse.get("dates", {}).get("end"),
-                parse.get("age_categories"),
+                arrival_date,
+                departure_date,
+                age_categories,
                 parse.get("accommodation_groups"),
                 parse.get("amenities")
             )
             if results:
-                for result in results:
-                    if result.get("id") in accommodations:
-                        result.update(accommodations[result.get("id")])
+                if future_accommodations is not None:
+                    accommodations = future_accommodations.result()
+                    for result in results:
+                        if (accommodation := accommodations.get(result.get("id"))) is not None:
+                            result |= accommodation
 
                 # sort results based on occurrence
-                query_words = original_user_query.split()
-                results.sort(
-                    key=lambda r: sum(
-                        word in unicodedata.normalize('NFD', r.get("name", "").lower()).encode('ascii','ignore').decode('utf-8')
-                        for word in query_words
-                    ),
-                    reverse=True
-                )
+                # query words and names are folded the same way, each name once per result;
+                # repeated query words are scanned for once and weighted by their count
+                query_words = Counter(self._remove_accents(original_user_query.lower()).split()).items()
+
+                def occurrences(result):
+                    name = self._remove_accents(result.get("name", "").lower())
+                    return sum(count for word, count in query_words if word in name)
+
+                results.sort(key=occurrences, reverse=True)
 
         return TommyResponse.success(data={"parse": parse, "results": results})
\ No newline at end of file
@@ -1,8 +1,10 @@
 from flask_restful import Api
 
+from api.common.response import output_json
 from api.resources.Catalog import Catalog, CatalogSearch
 
 api = Api(prefix="/api/v1", catch_all_404s=True)
+api.representations["application/json"] = output_json
 
 api.add_resource(Catalog, "/catalog/<uuid:catalog_id>")
 api.add_resource(CatalogSearch, "/catalog/<uuid:catalog_id>/search")
@@ -0,0 +1,28 @@
+import unittest
+
+from api.create_app import create_app
+
+
+class CatalogIdTest(unittest.TestCase):
+    UNKNOWN_CATALOG_ID = "00000000-0000-4000-8000-000000000000"
+
+    def setUp(self):
+        self.client = create_app().test_client()
+
+    def assert_bad_request(self, response):
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json(), {
+            "status": "error",
+            "message": "Invalid formatting. Please ensure you're using the schema.",
+            "error": "BadRequestError",
+        })
+
+    def test_unknown_catalog_is_bad_request(self):
+        self.assert_bad_request(self.client.get(f"/api/v1/catalog/{self.UNKNOWN_CATALOG_ID}"))
+
+    def test_unknown_catalog_search_is_bad_request(self):
+        self.assert_bad_request(self.client.get(f"/api/v1/catalog/{self.UNKNOWN_CATALOG_ID}/search?q=chalet"))
+
+
+if __name__ == "__main__":
+    unittest.main()